@@ -12,6 +12,7 @@ from transformers import AutoTokenizer
 import tensorrt_llm
 import tensorrt_llm.profiler as profiler
 from tensorrt_llm import logger
+from tensorrt_llm._utils import trt_dtype_to_torch
 from tensorrt_llm.runtime import Session, TensorInfo
 
 
@@ -19,17 +20,6 @@ def get_engine_name(rank):
     return 'rank{}.engine'.format(rank)
 
 
-def trt_dtype_to_torch(dtype):
-    if dtype == trt.float16:
-        return torch.float16
-    elif dtype == trt.float32:
-        return torch.float32
-    elif dtype == trt.int32:
-        return torch.int32
-    else:
-        raise TypeError("%s is not supported" % dtype)
-
-
 def TRTOPT(args, config):
     dtype = config['pretrained_config']['dtype']
     world_size = config['pretrained_config']['mapping']['world_size']
@@ -1,13 +1,12 @@
 import argparse
 import json
+import mmap
 import os
 from pathlib import Path
 
-# isort: off
-import torch
-import tensorrt as trt
-# isort: on
+import numpy as np
 import requests
+import torch
 from PIL import Image
 from transformers import (AutoTokenizer, Blip2ForConditionalGeneration,
                           Blip2Processor)
@@ -17,22 +16,15 @@ import tensorrt_llm.profiler as profiler
 from tensorrt_llm import logger
 
 
-def get_engine_name(rank):
-    return 'rank{}.engine'.format(rank)
+# Default all-zero prompt task ids on the GPU, keyed by number of sequences.
+_zero_tasks = {}
 
 
-def trt_dtype_to_torch(dtype):
-    if dtype == trt.float16:
-        return torch.float16
-    elif dtype == trt.float32:
-        return torch.float32
-    elif dtype == trt.int32:
-        return torch.int32
-    else:
-        raise TypeError("%s is not supported" % dtype)
+def get_engine_name(rank):
+    return 'rank{}.engine'.format(rank)
 
 
-def TRTOPT(args, config):
+def TRTOPT(args, config, runtime_mapping):
     dtype = config['pretrained_config']['dtype']
     world_size = config['pretrained_config']['mapping']['world_size']
     assert world_size == tensorrt_llm.mpi_world_size(), \
@@ -64,20 +56,18 @@ def TRTOPT(args, config):
         max_prompt_embedding_table_size=max_prompt_embedding_table_size,
         dtype=dtype)
 
-    runtime_rank = tensorrt_llm.mpi_rank()
-    runtime_mapping = tensorrt_llm.Mapping(world_size, runtime_rank)
-    torch.cuda.set_device(runtime_rank % runtime_mapping.gpus_per_node)
-
-    engine_name = get_engine_name(runtime_rank)
+    engine_name = get_engine_name(runtime_mapping.rank)
     serialize_path = os.path.join(args.engine_dir, engine_name)
 
     tensorrt_llm.logger.set_level(args.log_level)
 
-    with open(serialize_path, 'rb') as f:
-        engine_buffer = f.read()
-    decoder = tensorrt_llm.runtime.GenerationSession(model_config,
-                                                     engine_buffer,
-                                                     runtime_mapping)
+    # Map the engine file instead of reading it into a bytes object, so it is
+    # only copied once, by the TRT deserializer, straight from the page cache.
+    with open(serialize_path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+            memoryview(mm) as engine_buffer:
+        decoder = tensorrt_llm.runtime.GenerationSession(
+            model_config, engine_buffer, runtime_mapping)
 
     max_input_len = config['build_config']['max_input_len']
     return decoder, model_config, world_size, dtype, max_input_len
@@ -104,15 +94,82 @@ def ptuning_setup(prompt_table, dtype, hidden_size, tasks, input_ids,
     if tasks is not None:
         tasks = torch.tensor([int(t) for t in tasks.split(',')],
                              dtype=torch.int32,
-                             device="cuda")
+                             pin_memory=True).cuda(non_blocking=True)
         assert tasks.shape[
             0] == num_sequences, "Number of supplied tasks must match input batch size"
     else:
-        tasks = torch.zeros([num_sequences], dtype=torch.int32).cuda()
+        if num_sequences not in _zero_tasks:
+            _zero_tasks[num_sequences] = torch.zeros([num_sequences],
+                                                     dtype=torch.int32,
+                                                     device="cuda")
+        tasks = _zero_tasks[num_sequences]
 
     return [prompt_table, tasks, task_vocab_size]
 
 
+def _blip_preproc(image, height, width, mean, std):
+    # HWC uint8 -> NCHW, resized, normalized and cast to FP16.
+    image = image.permute(2, 0, 1).unsqueeze(0).float()
+    image = torch.nn.functional.interpolate(image,
+                                            size=(height, width),
+                                            mode='bicubic',
+                                            align_corners=False,
+                                            antialias=True)
+    # HF resizes through PIL, which hands back uint8: round and clip first.
+    image = (image.round().clamp(0, 255) / 255 - mean) / std
+    return image.to(torch.float16).contiguous()
+
+
+class Blip2ImagePreprocessor:
+    """GPU replacement for `Blip2Processor(images=raw_image)['pixel_values']`.
+
+    Only the uint8 HWC image is copied to the device, the bicubic resize,
+    rescale, normalization, HWC->CHW transpose and FP16 cast run there. They
+    run as separate eager kernels unless `use_torch_compile` fuses them. The
+    resize uses the antialiased bicubic of PyTorch, which approximates PIL's
+    rather than reproducing it bit for bit.
+    """
+
+    def __init__(self, image_processor, device, use_torch_compile=False):
+        self.device = device
+        self.height = image_processor.size['height']
+        self.width = image_processor.size['width']
+        self.mean = torch.tensor(image_processor.image_mean,
+                                 dtype=torch.float32,
+                                 device=device).view(1, -1, 1, 1)
+        self.std = torch.tensor(image_processor.image_std,
+                                dtype=torch.float32,
+                                device=device).view(1, -1, 1, 1)
+        # torch.compile fuses the pointwise ops into a single kernel, but the
+        # first call pays the compilation. That only pays off when many images
+        # are processed by the same process.
+        self.preproc = torch.compile(
+            _blip_preproc, dynamic=True) if use_torch_compile else _blip_preproc
+
+        # Pinned staging buffer for the H2D copy, grown to the largest image
+        # seen so far.
+        self.staging = torch.empty(0, dtype=torch.uint8, pin_memory=True)
+        self.copy_done = torch.cuda.Event()
+
+    def image_to_device(self, image):
+        # Do not overwrite the buffer while a previous copy may still read it.
+        self.copy_done.synchronize()
+        if image.numel() > self.staging.numel():
+            self.staging = torch.empty(image.numel(),
+                                       dtype=torch.uint8,
+                                       pin_memory=True)
+        staged = self.staging[:image.numel()].view(image.shape)
+        staged.copy_(image)
+        image = staged.to(self.device, non_blocking=True)
+        self.copy_done.record()
+        return image
+
+    def __call__(self, raw_image):
+        image = self.image_to_device(torch.from_numpy(np.array(raw_image)))
+        return self.preproc(image, self.height, self.width, self.mean,
+                            self.std)
+
+
 def parse_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument('--max_output_len', type=int, default=30)
@@ -136,6 +193,16 @@ def parse_arguments():
                         default=32)
     parser.add_argument('--top_k', type=int, default=1)
     parser.add_argument('--check_accuracy', action='store_true')
+    parser.add_argument(
+        '--torch_compile_preprocess',
+        action='store_true',
+        help="Fuse image preprocessing with torch.compile. Adds compilation "
+        "time to the first image, only worth it when processing many images")
+    parser.add_argument(
+        '--use_cuda_graph',
+        action='store_true',
+        help="Replay ViT + Q-Former through a captured CUDA graph. The capture "
+        "costs an extra forward, only worth it when encoding many images")
 
     return parser.parse_args()
 
@@ -153,8 +220,9 @@ class ViT_qformer_wrapper(torch.nn.Module):
     def forward(self, image):
         image_embeds = self.visual_wrapper(image)[0]
 
-        image_atts = torch.ones(image_embeds.size()[:-1],
-                                dtype=torch.long).to(image.device)
+        image_atts = torch.ones(image_embeds.shape[:-1],
+                                dtype=torch.long,
+                                device=image.device)
         query_tokens = self.query_tokens.expand(image_embeds.shape[0], -1, -1)
         query_output = self.qformer(query_embeds=query_tokens,
                                     encoder_hidden_states=image_embeds,
@@ -164,11 +232,55 @@ class ViT_qformer_wrapper(torch.nn.Module):
         return self.opt_proj(query_output.last_hidden_state)
 
 
+class ViT_qformer_graph_runner:
+    """Replay ViT + Q-Former through a captured CUDA graph.
+
+    The HF vision model and Q-Former launch many small kernels, so at small
+    batch sizes the forward is bound by host-side dispatch. The graph is
+    captured once against a static input buffer and replayed afterwards.
+    """
+
+    def __init__(self, vit_qformer, image):
+        self.static_image = torch.empty_like(image)
+        self.static_image.copy_(image)
+
+        # Warm up on a side stream so lazy initialization (cuDNN/cuBLAS
+        # handles, algorithm selection) is not recorded into the graph.
+        warmup_stream = torch.cuda.Stream()
+        warmup_stream.wait_stream(torch.cuda.current_stream())
+        with torch.no_grad(), torch.cuda.stream(warmup_stream):
+            inputs_opt = vit_qformer(self.static_image)
+        torch.cuda.current_stream().wait_stream(warmup_stream)
+
+        self.static_out = torch.empty_like(inputs_opt)
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.no_grad(), torch.cuda.graph(self.graph):
+            self.static_out.copy_(vit_qformer(self.static_image))
+
+    def __call__(self, image):
+        assert image.shape == self.static_image.shape, \
+            f'Input shape {tuple(image.shape)} != captured shape {tuple(self.static_image.shape)}'
+        self.static_image.copy_(image, non_blocking=True)
+        self.graph.replay()
+        return self.static_out
+
+
 if __name__ == '__main__':
     args = parse_arguments()
 
     tensorrt_llm.logger.set_level(args.log_level)
 
+    engine_dir = Path(args.engine_dir)
+    config_path = engine_dir / 'config.json'
+    with open(config_path, 'r') as f:
+        config = json.load(f)
+
+    runtime_rank = tensorrt_llm.mpi_rank()
+    runtime_mapping = tensorrt_llm.Mapping(
+        config['pretrained_config']['mapping']['world_size'], runtime_rank)
+    # Select the device before any CUDA call so the context is created on it.
+    torch.cuda.set_device(runtime_rank % runtime_mapping.gpus_per_node)
+
     stream = torch.cuda.current_stream().cuda_stream
 
     img_url = 'https://storage.googleapis.com/sfr-vision-language-research/LAVIS/assets/merlion.png'
@@ -178,25 +290,36 @@ if __name__ == '__main__':
     device = torch.device("cuda") if torch.cuda.is_available() else "cpu"
 
     processor = Blip2Processor.from_pretrained("Salesforce/blip2-opt-2.7b")
+    # Only the image encoder path runs in PyTorch, the OPT language model is
+    # served by the TRT-LLM engine. Keep the HF copy of it off the GPU.
+    device_map = {
+        name: device
+        for name in ('query_tokens', 'vision_model', 'qformer',
+                     'language_projection')
+    }
+    device_map['language_model'] = 'cpu'
     blip2_model = Blip2ForConditionalGeneration.from_pretrained(
-        "Salesforce/blip2-opt-2.7b", torch_dtype=torch.float16)
-    blip2_model.to(device)
+        "Salesforce/blip2-opt-2.7b",
+        torch_dtype=torch.float16,
+        low_cpu_mem_usage=True,
+        device_map=device_map)
 
     prompt = args.input_text
-    inputs = processor(images=raw_image, text=prompt,
-                       return_tensors="pt").to(device, torch.float16)
-
-    image = inputs['pixel_values']
-
-    vit_qformer = ViT_qformer_wrapper(blip2_model)
+    image_preprocessor = Blip2ImagePreprocessor(
+        processor.image_processor,
+        device,
+        use_torch_compile=args.torch_compile_preprocess)
+    image = image_preprocessor(raw_image)
 
     batch_size = 1
     image = image.expand(batch_size, -1, -1, -1).contiguous()
-    inputs_opt = vit_qformer(image)
-    atts_opt = torch.ones(inputs_opt.size()[:-1],
-                          dtype=torch.long).to(image.device)
-
-    prompt = [prompt] * image.size(0)
+    vit_qformer = ViT_qformer_wrapper(blip2_model)
+    # The wrapper keeps the submodules it needs, release the rest.
+    del blip2_model.language_model
+    del blip2_model
+    torch.cuda.empty_cache()
+    if args.use_cuda_graph:
+        vit_qformer = ViT_qformer_graph_runner(vit_qformer, image)
 
     opt_tokenizer = AutoTokenizer.from_pretrained(args.hf_model_location,
                                                   use_fast=False)
@@ -204,26 +327,40 @@ if __name__ == '__main__':
 
     end_id = opt_tokenizer("\n", add_special_tokens=False).input_ids[0]
 
-    engine_dir = Path(args.engine_dir)
-    config_path = engine_dir / 'config.json'
-    with open(config_path, 'r') as f:
-        config = json.load(f)
     tensorrt_llm_opt, model_config, world_size, dtype, max_input_len = TRTOPT(
-        args, config)
+        args, config, runtime_mapping)
     vocab_size = model_config.vocab_size
 
-    def opt_blip2(prompt, inputs_opt, atts_opt):
+    enc_stream = torch.cuda.Stream()
+
+    def opt_blip2(prompt, image):
         profiler.start("OPT")
+        # Run ViT + Q-Former on a side stream so that the tokenizer and the
+        # attention mask assembly below overlap with the image encoder.
+        enc_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(enc_stream):
+            inputs_opt = vit_qformer(image)
+        atts_opt = torch.ones(inputs_opt.shape[:-1],
+                              dtype=torch.int32,
+                              device=inputs_opt.device)
+
+        # The prompt is shared by the whole batch, tokenize it only once.
         opt_tokens = opt_tokenizer(
             prompt,
             return_tensors="pt",
-            padding="longest",
             truncation=True,
             max_length=args.max_txt_len,
         ).to(image.device)
+        opt_input_ids = opt_tokens.input_ids.expand(image.size(0), -1)
+        opt_attention_mask = opt_tokens.attention_mask.expand(
+            image.size(0), -1)
+
+        # Sum both mask pieces directly instead of reducing their concatenation.
+        input_lengths = (atts_opt.sum(dim=1) +
+                         opt_attention_mask.sum(dim=1)).to(torch.int32)
 
-        attention_mask = torch.cat([atts_opt, opt_tokens.attention_mask], dim=1)
-        input_lengths = torch.sum(attention_mask, dim=1).to(torch.int32).cuda()
+        # The prompt table is consumed below, join the image encoder stream.
+        torch.cuda.current_stream().wait_stream(enc_stream)
 
         sampling_config = tensorrt_llm.runtime.SamplingConfig(
             end_id=end_id,
@@ -236,12 +373,13 @@ if __name__ == '__main__':
         fake_prompt_id = torch.arange(vocab_size,
                                       vocab_size +
                                       inputs_opt.shape[0] * inputs_opt.shape[1],
-                                      device='cuda')
-        fake_prompt_id = fake_prompt_id.reshape(inputs_opt.shape[0],
-                                                inputs_opt.shape[1])
-        input_ids = torch.cat([fake_prompt_id, opt_tokens.input_ids],
-                              dim=1).contiguous()
-        input_ids = input_ids.to(torch.int32).cuda()
+                                      dtype=torch.int32,
+                                      device='cuda').view(
+                                          inputs_opt.shape[0],
+                                          inputs_opt.shape[1])
+        input_ids = torch.cat(
+            [fake_prompt_id,
+             opt_input_ids.to(torch.int32)], dim=1)
 
         ptuning_args = ptuning_setup(inputs_opt, dtype,
                                      model_config.hidden_size, None, input_ids,
@@ -249,7 +387,9 @@ if __name__ == '__main__':
                                      model_config.remove_input_padding)
 
         with torch.no_grad():
-            max_input_length = torch.max(input_lengths).item()
+            # All sequences share the unpadded prompt, so the max length is
+            # known from the shapes without a device sync.
+            max_input_length = inputs_opt.shape[1] + opt_attention_mask.shape[1]
             tensorrt_llm_opt.setup(batch_size,
                                    max_context_length=max_input_length,
                                    max_new_tokens=args.max_output_len)
@@ -266,20 +406,20 @@ if __name__ == '__main__':
 
         profiler.stop("OPT")
 
-        # Extract a list of tensors of shape beam_width x output_ids.
-        output_beams_list = [
-            opt_tokenizer.batch_decode(output_ids[batch_idx, :,
-                                                  input_lengths[batch_idx]:],
-                                       skip_special_tokens=True)
-            for batch_idx in range(batch_size)
+        # Every sequence shares the same prompt, so the generated tokens of
+        # all batch entries and beams start at the same offset and can be
+        # decoded with a single call.
+        output_beams = opt_tokenizer.batch_decode(
+            output_ids[:, :, max_input_length:].reshape(
+                batch_size * args.num_beams, -1).cpu(),
+            skip_special_tokens=True)
+        stripped_text = [
+            [text.strip() for text in output_beams[i:i + args.num_beams]]
+            for i in range(0, len(output_beams), args.num_beams)
         ]
-        stripped_text = [[
-            output_beams_list[batch_idx][beam_idx].strip()
-            for beam_idx in range(args.num_beams)
-        ] for batch_idx in range(batch_size)]
         return stripped_text
 
-    stripped_text = opt_blip2(prompt, inputs_opt, atts_opt)
+    stripped_text = opt_blip2(prompt, image)
     if args.check_accuracy:
         assert stripped_text[0][0] == "singapore"
     logger.info("---------------------------------------------------------")
@@ -12,6 +12,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import functools
 import os
 import sys
 import unittest
@@ -23,7 +24,9 @@ import torch
 import tensorrt as trt
 # isort: on
 from parameterized import parameterized
-from polygraphy.backend.trt import CreateConfig, EngineFromNetwork, TrtRunner
+from polygraphy.backend.trt import (CreateConfig, EngineFromNetwork, Profile,
+                                    TrtRunner)
+from polygraphy.cuda import DeviceView
 
 import tensorrt_llm
 from tensorrt_llm import Tensor
@@ -34,95 +37,146 @@ sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 from utils.util import getSMVersion
 
 
+# Each configuration is checked for several m against a single engine built
+# with a dynamic m. Configurations that only the CUTLASS kernels support
+# (flexible group sizes, W4A8) stay on m >= 16, as the CUDA kernels used
+# for small m do not handle them.
+M_SWEEP = (1, 16, 32, 64)
+MAX_M = max(M_SWEEP)
+
+
+@functools.lru_cache
+def _build_matmul_engine(dtype, quant_algo, group_size, k,
+                         pre_quant_scale_shape, weight_shape, scale_shape,
+                         zero_shape, bias_shape, alpha_shape):
+    # Several tests share configurations (e.g. the prequant group 64/128
+    # cases on Hopper), so identical networks are only built once.
+    # Create builder
+    builder = tensorrt_llm.Builder()
+    net = builder.create_network()
+    net.plugin_config.set_weight_only_groupwise_quant_matmul_plugin(dtype)
+    with tensorrt_llm.net_guard(net):
+        network = tensorrt_llm.default_trtnet()
+        # Init TensorRT-LLM tensor for activation
+        activation = Tensor(name='activation',
+                            shape=(-1, k),
+                            dtype=tensorrt_llm._utils.str_dtype_to_trt(dtype))
+        # Init TensorRT-LLM tensor for pre_quant_scale
+        pre_quant_scale = Tensor(
+            name='pre_quant_scale',
+            shape=pre_quant_scale_shape,
+            dtype=tensorrt_llm._utils.str_dtype_to_trt(dtype))
+        # Init TensorRT-LLM tensor for weight
+        weight = Tensor(name='weight',
+                        shape=weight_shape,
+                        dtype=tensorrt_llm._utils.str_dtype_to_trt("float16"))
+        # Init TensorRT-LLM tensor for scale
+        scale = Tensor(name='scale',
+                       shape=scale_shape,
+                       dtype=tensorrt_llm._utils.str_dtype_to_trt(dtype))
+        # Init TensorRT-LLM tensor for zero
+        zero = Tensor(name='zero',
+                      shape=zero_shape,
+                      dtype=tensorrt_llm._utils.str_dtype_to_trt(dtype))
+        # Init TensorRT-LLM tensor for bias
+        bias = Tensor(name='bias',
+                      shape=bias_shape,
+                      dtype=tensorrt_llm._utils.str_dtype_to_trt(dtype))
+        # Init TensorRT-LLM tensor for alpha
+        alpha = Tensor(name='alpha',
+                       shape=alpha_shape,
+                       dtype=tensorrt_llm._utils.str_dtype_to_trt("float32"))
+
+        # Get output tensor for WBQ Matmul
+        output = weight_only_groupwise_quant_matmul(activation, pre_quant_scale,
+                                                    weight, scale, zero, bias,
+                                                    alpha, quant_algo,
+                                                    group_size).trt_tensor
+        output.name = 'output'
+        network.mark_output(output)
+        output.dtype = tensorrt_llm._utils.str_dtype_to_trt(dtype)
+
+    # Build engine consisting of only WBQ Matmul
+    profiles = [Profile().add('activation', (1, k), (MAX_M, k), (MAX_M, k))]
+    build_engine = EngineFromNetwork(
+        (builder.trt_builder, net.trt_network),
+        config=CreateConfig(
+            fp16=(dtype == "float16"),
+            memory_pool_limits={trt.MemoryPoolType.WORKSPACE: 33554432},
+            profiles=profiles))
+    return build_engine()
+
+
+@functools.lru_cache(maxsize=None)
+def _gen_int4_weights(k, n, uint4_input):
+    # The random weights only depend on (k, n, uint4_input), so packing and
+    # preprocessing run once per weight shape across parameterized cases.
+    # Returns the unpacked int8 weight and its interleaved int4x2 layout,
+    # both on the GPU; callers must not modify them in place.
+    generator = torch.Generator().manual_seed(0)
+    qweight_unprocessed = torch.randint(-2**31,
+                                        2**31, (k // 8, n),
+                                        generator=generator).int()
+    packer = torch.ops.trtllm.pack_int8_tensor_to_packed_int4
+    preprocessor = torch.ops.trtllm.preprocess_weights_for_mixed_gemm
+    qweight_int8 = _utils.woq_groupwise_extract_int4(qweight_unprocessed,
+                                                     uint4_input).char()
+    qweight_int4x2_interleaved = preprocessor(
+        packer(qweight_int8 - uint4_input * 8),
+        torch.quint4x2).view(torch.float16)
+    return qweight_int8.cuda(), qweight_int4x2_interleaved.cuda()
+
+
+def _to_device_view(tensor):
+    # Empty optional inputs have no storage to point at, pass them as-is.
+    if tensor.numel() == 0:
+        return tensor.cpu().numpy()
+    return DeviceView(ptr=tensor.data_ptr(),
+                      shape=tuple(tensor.shape),
+                      dtype=tensorrt_llm._utils.torch_dtype_to_np(tensor.dtype))
+
+
 class TestWeightOnlyGroupWiseQuantMatmul(unittest.TestCase):
 
     def setUp(self):
         tensorrt_llm.logger.set_level('error')
 
     def _run_matmul_plugin(self,
+                           runner,
                            th_activation,
                            th_pre_quant_scale,
                            th_weight,
                            th_scale,
                            th_zero,
                            th_bias,
-                           th_alpha,
-                           dtype,
-                           quant_algo,
-                           group_size=128):
-        # Create builder
-        builder = tensorrt_llm.Builder()
-        net = builder.create_network()
-        net.plugin_config.set_weight_only_groupwise_quant_matmul_plugin(dtype)
-        with tensorrt_llm.net_guard(net):
-            network = tensorrt_llm.default_trtnet()
-            # Init TensorRT-LLM tensor for activation
-            activation = Tensor(
-                name='activation',
-                shape=th_activation.shape,
-                dtype=tensorrt_llm._utils.str_dtype_to_trt(dtype))
-            # Init TensorRT-LLM tensor for pre_quant_scale
-            pre_quant_scale = Tensor(
-                name='pre_quant_scale',
-                shape=th_pre_quant_scale.shape,
-                dtype=tensorrt_llm._utils.str_dtype_to_trt(dtype))
-            # Init TensorRT-LLM tensor for weight
-            weight = Tensor(
-                name='weight',
-                shape=th_weight.shape,
-                dtype=tensorrt_llm._utils.str_dtype_to_trt("float16"))
-            # Init TensorRT-LLM tensor for scale
-            scale = Tensor(name='scale',
-                           shape=th_scale.shape,
-                           dtype=tensorrt_llm._utils.str_dtype_to_trt(dtype))
-            # Init TensorRT-LLM tensor for zero
-            zero = Tensor(name='zero',
-                          shape=th_zero.shape,
-                          dtype=tensorrt_llm._utils.str_dtype_to_trt(dtype))
-            # Init TensorRT-LLM tensor for bias
-            bias = Tensor(name='bias',
-                          shape=th_bias.shape,
-                          dtype=tensorrt_llm._utils.str_dtype_to_trt(dtype))
-            # Init TensorRT-LLM tensor for alpha
-            alpha = Tensor(
-                name='alpha',
-                shape=th_alpha.shape,
-                dtype=tensorrt_llm._utils.str_dtype_to_trt("float32"))
-
-            # Get output tensor for WBQ Matmul
-            output = weight_only_groupwise_quant_matmul(activation,
-                                                        pre_quant_scale, weight,
-                                                        scale, zero, bias,
-                                                        alpha, quant_algo,
-                                                        group_size).trt_tensor
-            output.name = 'output'
-            network.mark_output(output)
-            output.dtype = tensorrt_llm._utils.str_dtype_to_trt(dtype)
-
-        # Build engine consisting of only WBQ Matmul
-        build_engine = EngineFromNetwork(
-            (builder.trt_builder, net.trt_network),
-            config=CreateConfig(
-                fp16=(dtype == "float16"),
-                memory_pool_limits={trt.MemoryPoolType.WORKSPACE: 33554432}))
+                           th_alpha):
+        # Keep the inputs resident on the GPU and hand their device pointers
+        # to polygraphy, avoiding a D2H + H2D round trip per input.
+        inputs = {
+            'activation': th_activation,
+            'pre_quant_scale': th_pre_quant_scale,
+            'weight': th_weight,
+            'scale': th_scale,
+            'zero': th_zero,
+            'bias': th_bias,
+            'alpha': th_alpha
+        }
+        inputs = {
+            name: tensor.cuda().contiguous()
+            for name, tensor in inputs.items()
+        }
+        torch.cuda.synchronize()
 
         # Infer engine
-        with TrtRunner(build_engine) as runner:
-            outputs = runner.infer(
-                feed_dict={
-                    'activation': th_activation.numpy(),
-                    'pre_quant_scale': th_pre_quant_scale.numpy(),
-                    'weight': th_weight.numpy(),
-                    'scale': th_scale.numpy(),
-                    'zero': th_zero.numpy(),
-                    'bias': th_bias.numpy(),
-                    'alpha': th_alpha.numpy()
-                })
+        outputs = runner.infer(feed_dict={
+            name: _to_device_view(tensor)
+            for name, tensor in inputs.items()
+        })
 
+        # polygraphy returns the output on the host, compare it there.
         return torch.tensor(outputs['output'])
 
     def _woq_groupwise_matmul(self,
-                              m,
                               n,
                               k,
                               dtype,
@@ -131,22 +185,25 @@ class TestWeightOnlyGroupWiseQuantMatmul(unittest.TestCase):
                               has_bias,
                               group_size=128,
                               uint4_input=True,
-                              use_w4a8_awq=False):
+                              use_w4a8_awq=False,
+                              ms=M_SWEEP):
         # Init operands for multiplication in int32
+        # The reference path runs on the GPU in fp16.
         torch.manual_seed(0)
-        activation = _utils.woq_gen_weights(m, k, dtype)
-        pre_quant_scale = _utils.woq_gen_weights(1, k, dtype)
-        qweight_unprocessed = torch.randint(-2**31, 2**31, (k // 8, n)).int()
+        device = 'cuda'
+        pre_quant_scale = _utils.woq_gen_weights(1, k, dtype, device=device)
         scale = _utils.woq_gen_weights(
-            (k + group_size) // group_size, n, dtype) * 2
+            (k + group_size) // group_size, n, dtype, device=device) * 2
         zero = _utils.woq_gen_weights(
-            (k + group_size) //
-            group_size, n, dtype) * 2 if has_zero else torch.Tensor().half()
+            (k + group_size) // group_size, n, dtype, device=device
+        ) * 2 if has_zero else torch.empty(0, dtype=torch.half, device=device)
         bias = _utils.woq_gen_weights(
-            1, n, dtype) if has_bias else torch.Tensor().half()
+            1, n, dtype, device=device) if has_bias else torch.empty(
+                0, dtype=torch.half, device=device)
         fp8_alpha = torch.randn(
-            1, dtype=torch.float32) + 0.5 if use_w4a8_awq else torch.Tensor(
-            ).float()
+            1, dtype=torch.float32,
+            device=device) + 0.5 if use_w4a8_awq else torch.empty(
+                0, dtype=torch.float32, device=device)
         # Flags for indicating whether the corresponding inputs are applied in quant_algo
         BIAS = 1
         ZERO = 2
@@ -155,13 +212,8 @@ class TestWeightOnlyGroupWiseQuantMatmul(unittest.TestCase):
 
         quant_algo = use_w4a8_awq * W4A8_AWQ + has_pre_quant * PRE_QUANT_SCALE + has_zero * ZERO + has_bias * BIAS
 
-        packer = torch.ops.trtllm.pack_int8_tensor_to_packed_int4
-        preprocessor = torch.ops.trtllm.preprocess_weights_for_mixed_gemm
-        qweight_int8 = _utils.woq_groupwise_extract_int4(
-            qweight_unprocessed, uint4_input).char()
-        qweight_int4x2_interleaved = preprocessor(
-            packer(qweight_int8 - uint4_input * 8),
-            torch.quint4x2).view(torch.float16)
+        qweight_int8, qweight_int4x2_interleaved = _gen_int4_weights(
+            k, n, uint4_input)
 
         input_rows = qweight_int8.shape[0]
         scale_ref = scale.repeat_interleave(group_size, dim=0)[input_rows, :]
@@ -172,36 +224,50 @@ class TestWeightOnlyGroupWiseQuantMatmul(unittest.TestCase):
             zero_ref = zero.repeat_interleave(group_size, dim=0)[input_rows, :]
             ref_th_weight += zero_ref
 
-        activation = torch.zeros_like(activation)
         bias = torch.ones_like(bias)
-        output = self._run_matmul_plugin(activation, pre_quant_scale,
-                                         qweight_int4x2_interleaved, scale,
-                                         zero, bias, fp8_alpha, dtype,
-                                         quant_algo, group_size).cpu()
-
-        if use_w4a8_awq:
-            activation *= fp8_alpha
-
-        if has_pre_quant:
-            pre_quant_scale = pre_quant_scale.repeat(m, 1)
-            activation = torch.mul(activation, pre_quant_scale)
-
-        ref = _utils.woq_groupwise_gt_matmul(activation, ref_th_weight, bias)
-
-        _utils.woq_assert_colwise_near_eq(ref, output, 2)
-
-    @parameterized.expand([(1, 1024, 64, 'float16', False, True, True, 64),
-                           (16, 1024, 256, 'float16', False, True, False, 64),
-                           (32, 2048, 384, 'float16', False, False, True, 64),
-                           (64, 2048, 1024, 'float16', False, False, False, 64),
-                           (1, 1024, 128, 'float16', False, True, True, 128),
-                           (16, 1024, 256, 'float16', False, True, False, 128),
-                           (32, 2048, 384, 'float16', False, False, True, 128),
-                           (64, 2048, 1024, 'float16', False, False, False, 128)
+
+        engine = _build_matmul_engine(dtype, quant_algo, group_size, k,
+                                      tuple(pre_quant_scale.shape),
+                                      tuple(qweight_int4x2_interleaved.shape),
+                                      tuple(scale.shape), tuple(zero.shape),
+                                      tuple(bias.shape), tuple(fp8_alpha.shape))
+
+        # One activated runner, and its execution context, serves every m.
+        with TrtRunner(engine) as runner:
+            for m in ms:
+                with self.subTest(m=m):
+                    activation = torch.zeros(
+                        (m, k),
+                        dtype=_utils.woq_torch_dtype(dtype),
+                        device=device)
+                    output = self._run_matmul_plugin(
+                        runner, activation, pre_quant_scale,
+                        qweight_int4x2_interleaved, scale, zero, bias,
+                        fp8_alpha)
+
+                    if use_w4a8_awq:
+                        activation *= fp8_alpha
+
+                    if has_pre_quant:
+                        # (1, k) scale broadcasts over the (m, k) activation
+                        activation = activation * pre_quant_scale
+
+                    ref = _utils.woq_groupwise_gt_matmul(
+                        activation, ref_th_weight, bias)
+
+                    _utils.woq_assert_colwise_near_eq(ref.cpu(), output, 2)
+
+    @parameterized.expand([(1024, 64, 'float16', False, True, True, 64),
+                           (1024, 256, 'float16', False, True, False, 64),
+                           (2048, 384, 'float16', False, False, True, 64),
+                           (2048, 1024, 'float16', False, False, False, 64),
+                           (1024, 128, 'float16', False, True, True, 128),
+                           (1024, 256, 'float16', False, True, False, 128),
+                           (2048, 384, 'float16', False, False, True, 128),
+                           (2048, 1024, 'float16', False, False, False, 128)
                            ])
     @unittest.skipIf(getSMVersion() < 80, "Unsupported test on pre-Ampere.")
     def test_matmul_int4_input(self,
-                               m,
                                n,
                                k,
                                dtype,
@@ -209,8 +275,7 @@ class TestWeightOnlyGroupWiseQuantMatmul(unittest.TestCase):
                                has_zero,
                                has_bias,
                                group_size=128):
-        self._woq_groupwise_matmul(m,
-                                   n,
+        self._woq_groupwise_matmul(n,
                                    k,
                                    dtype,
                                    has_pre_quant,
@@ -219,18 +284,17 @@ class TestWeightOnlyGroupWiseQuantMatmul(unittest.TestCase):
                                    group_size,
                                    uint4_input=(getSMVersion() < 90))
 
-    @parameterized.expand([(1, 1024, 64, 'float16', True, True, True, 64),
-                           (16, 1024, 256, 'float16', True, True, False, 64),
-                           (32, 2048, 384, 'float16', True, False, True, 64),
-                           (64, 2048, 1024, 'float16', True, False, False, 64),
-                           (1, 1024, 128, 'float16', True, True, True, 128),
-                           (16, 1024, 256, 'float16', True, True, False, 128),
-                           (32, 2048, 384, 'float16', True, False, True, 128),
-                           (64, 2048, 1024, 'float16', True, False, False, 128)]
+    @parameterized.expand([(1024, 64, 'float16', True, True, True, 64),
+                           (1024, 256, 'float16', True, True, False, 64),
+                           (2048, 384, 'float16', True, False, True, 64),
+                           (2048, 1024, 'float16', True, False, False, 64),
+                           (1024, 128, 'float16', True, True, True, 128),
+                           (1024, 256, 'float16', True, True, False, 128),
+                           (2048, 384, 'float16', True, False, True, 128),
+                           (2048, 1024, 'float16', True, False, False, 128)]
                           )
     @unittest.skipIf(getSMVersion() < 80, "Unsupported test on pre-Ampere.")
     def test_prequant_matmul_int4_input(self,
-                                        m,
                                         n,
                                         k,
                                         dtype,
@@ -238,8 +302,7 @@ class TestWeightOnlyGroupWiseQuantMatmul(unittest.TestCase):
                                         has_zero,
                                         has_bias,
                                         group_size=128):
-        self._woq_groupwise_matmul(m,
-                                   n,
+        self._woq_groupwise_matmul(n,
                                    k,
                                    dtype,
                                    has_pre_quant,
@@ -249,20 +312,19 @@ class TestWeightOnlyGroupWiseQuantMatmul(unittest.TestCase):
                                    uint4_input=(getSMVersion() < 90))
 
     @parameterized.expand([
-        (1, 1024, 128, 'float16', True, True, True, 64, False),
-        (1, 1024, 128, 'float16', True, True, True, 128, False),
-        (16, 1024, 256, 'float16', True, True, False, 128, True),
-        (32, 2048, 384, 'float16', True, False, True, 128, False),
-        (64, 2048, 1024, 'float16', True, False, False, 128, True)
+        (1024, 128, 'float16', True, True, True, 64, False),
+        (1024, 128, 'float16', True, True, True, 128, False),
+        (1024, 256, 'float16', True, True, False, 128, True),
+        (2048, 384, 'float16', True, False, True, 128, False),
+        (2048, 1024, 'float16', True, False, False, 128, True)
     ])
     @unittest.skipIf(getSMVersion() != 90,
                      "Hopper dedicated test, not supported on pre-Hopper.")
-    def test_prequant_matmul_fp8_int4_input_hopper(self, m, n, k, dtype,
+    def test_prequant_matmul_fp8_int4_input_hopper(self, n, k, dtype,
                                                    has_pre_quant, has_zero,
                                                    has_bias, group_size,
                                                    use_w4a8_awq):
-        self._woq_groupwise_matmul(m,
-                                   n,
+        self._woq_groupwise_matmul(n,
                                    k,
                                    dtype,
                                    has_pre_quant,
@@ -270,48 +332,48 @@ class TestWeightOnlyGroupWiseQuantMatmul(unittest.TestCase):
                                    has_bias,
                                    group_size,
                                    uint4_input=False,
-                                   use_w4a8_awq=use_w4a8_awq)
+                                   use_w4a8_awq=use_w4a8_awq,
+                                   ms=(16, 64) if use_w4a8_awq else M_SWEEP)
 
     # On hopper, any multiple of 64 works as a group size for FP16, with the CUTLASS kernel
     # We keep some unit tests to ensure that this support is maintained, even if the CUDA kernels
     # do not support it at the moment.
-    @parameterized.expand([(32, 1024, 128, 'float16', True, True, True, 64),
-                           (32, 1024, 128, 'float16', True, True, True, 128),
-                           (32, 1024, 256, 'float16', True, True, False, 192),
-                           (32, 2048, 384, 'float16', True, False, True, 256),
-                           (64, 2048, 1024, 'float16', True, False, False, 320)]
+    @parameterized.expand([(1024, 128, 'float16', True, True, True, 64),
+                           (1024, 128, 'float16', True, True, True, 128),
+                           (1024, 256, 'float16', True, True, False, 192),
+                           (2048, 384, 'float16', True, False, True, 256),
+                           (2048, 1024, 'float16', True, False, False, 320)]
                           )
     @unittest.skipIf(getSMVersion() != 90,
                      "Hopper dedicated test, not supported on pre-Hopper.")
-    def test_hopper_fp16_int4_flexible_groups(self, m, n, k, dtype,
+    def test_hopper_fp16_int4_flexible_groups(self, n, k, dtype,
                                               has_pre_quant, has_zero, has_bias,
                                               group_size):
-        self._woq_groupwise_matmul(m,
-                                   n,
+        self._woq_groupwise_matmul(n,
                                    k,
                                    dtype,
                                    has_pre_quant,
                                    has_zero,
                                    has_bias,
                                    group_size,
-                                   uint4_input=False)
+                                   uint4_input=False,
+                                   ms=(32, 64))
 
     # On hopper, any multiple of 128 works as a group size for FP8, with the CUTLASS kernel
     # We keep some unit tests to ensure that this support is maintained, even if the CUDA kernels
     # do not support it at the moment.
-    @parameterized.expand([(32, 1024, 128, 'float16', True, True, True, 128),
-                           (32, 1024, 128, 'float16', True, True, True, 256),
-                           (32, 1024, 256, 'float16', True, True, False, 384),
-                           (32, 2048, 1024, 'float16', True, False, True, 512),
-                           (64, 2048, 2048, 'float16', True, False, False, 640)]
+    @parameterized.expand([(1024, 128, 'float16', True, True, True, 128),
+                           (1024, 128, 'float16', True, True, True, 256),
+                           (1024, 256, 'float16', True, True, False, 384),
+                           (2048, 1024, 'float16', True, False, True, 512),
+                           (2048, 2048, 'float16', True, False, False, 640)]
                           )
     @unittest.skipIf(getSMVersion() != 90,
                      "Hopper dedicated test, not supported on pre-Hopper.")
-    def test_hopper_fp8_int4_flexible_groups(self, m, n, k, dtype,
+    def test_hopper_fp8_int4_flexible_groups(self, n, k, dtype,
                                              has_pre_quant, has_zero, has_bias,
                                              group_size):
-        self._woq_groupwise_matmul(m,
-                                   n,
+        self._woq_groupwise_matmul(n,
                                    k,
                                    dtype,
                                    has_pre_quant,
@@ -319,7 +381,8 @@ class TestWeightOnlyGroupWiseQuantMatmul(unittest.TestCase):
                                    has_bias,
                                    group_size,
                                    uint4_input=False,
-                                   use_w4a8_awq=True)
+                                   use_w4a8_awq=True,
+                                   ms=(32, 64))
 
 
 if __name__ == '__main__':